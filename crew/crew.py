@@ -46,3 +46,26 @@ class RepoPilotCrew():
             process=Process.sequential,
             verbose=True,
         )
+
+
+# One crew per worker process, built once instead of on every kickoff
+_crew: RepoPilotCrew | None = None
+
+
+def init_crew_worker():
+    """Process-pool initializer: parse the YAML config and build the agents up front."""
+    global _crew
+    if _crew is None:
+        _crew = RepoPilotCrew()
+
+
+def run_ci_crew(inputs: dict) -> str:
+    """
+    Run the crew on *inputs* and return its final output as text.
+
+    Module-level (and returning a plain string) so it can be submitted to
+    a process pool.  Each worker runs one kickoff at a time, so reusing
+    the worker's crew between runs is safe.
+    """
+    init_crew_worker()
+    return str(_crew.crew().kickoff(inputs=inputs))
@@ -1,6 +1,8 @@
 import logging
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
-from routes.webhook import router as webhook_router
+from routes.webhook import router as webhook_router, create_crew_pool
+from services.es_service import ElasticsearchService
 import uvicorn
 
 logging.basicConfig(
@@ -8,10 +10,22 @@ logging.basicConfig(
     format="%(asctime)s  %(levelname)-8s  %(name)s  %(message)s",
 )
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Shared by the webhook's background tasks via request.app.state
+    app.state.es = ElasticsearchService()
+    app.state.crew_pool = create_crew_pool()
+    yield
+    app.state.crew_pool.shutdown(wait=False, cancel_futures=True)
+    app.state.es.close()  # flush fixes still queued for Elasticsearch
+
+
 app = FastAPI(
     title="RepoPilot — CI/CD AI Fix Agent",
     version="1.0.0",
     description="Receives CI/CD failure webhooks, analyses the error, fixes the code, and opens a PR.",
+    lifespan=lifespan,
 )
 
 # Register routes
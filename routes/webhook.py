@@ -1,15 +1,21 @@
+import io
 import json
+import orjson
 import logging
 import re
 import hmac
 import hashlib
 import os
-import requests
+import multiprocessing
 import time
+import threading
+from cachetools import TTLCache
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from fastapi import APIRouter, Request, HTTPException, BackgroundTasks
-from services.github_service import GitHubService
+from starlette.datastructures import State
+from services.github_service import API, GitHubService
 from services.es_service import ElasticsearchService
-from crew.crew import RepoPilotCrew
+from crew.crew import init_crew_worker, run_ci_crew
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -19,27 +25,103 @@ logger = logging.getLogger(__name__)
 router = APIRouter()
 
 WEBHOOK_SECRET = os.getenv("GITHUB_WEBHOOK_SECRET", "")
+WEBHOOK_SECRET_BYTES = WEBHOOK_SECRET.encode()
 
-es = ElasticsearchService()
+# Source code sent to the crew is capped at this many characters
+MAX_SOURCE_CHARS = 30_000
+# Concurrent GitHub content requests while collecting source code
+SOURCE_FETCH_WORKERS = int(os.getenv("SOURCE_FETCH_WORKERS", "8"))
+
+# "events": start the pipeline from workflow_run / check_suite completion
+# webhooks.  "poll": poll the Actions API after each push (wait_for_ci).
+CI_TRIGGER = os.getenv("CI_TRIGGER", "events")
+
+# GitHub events the webhook acts on; anything else is skipped unread
+HANDLED_EVENTS = {"push", "workflow_run", "check_suite"}
+
+# Crew kickoffs run in separate processes so long LLM orchestration doesn't
+# tie up the API worker; "spawn" avoids forking a multi-threaded server.
+CREW_WORKERS = int(os.getenv("CREW_WORKERS", "4"))
+
+# Lower-priority file types when choosing which sources to send to the crew
+_CONFIG_EXTENSIONS = {
+    ".yml", ".yaml", ".toml", ".json", ".cfg", ".ini", ".xml", ".gradle", ".dockerfile",
+}
+_MARKUP_EXTENSIONS = {".html", ".css", ".scss"}
+
+# Never sent to the crew: generated content that only costs prompt tokens
+_LOCKFILE_NAMES = {"package-lock.json", "npm-shrinkwrap.json", "pnpm-lock.yaml"}
+_GENERATED_DIRS = ("node_modules", "__pycache__", "vendor", "dist")
+
+# Lines kept from each end of a file that doesn't fit in the source budget
+TRUNCATED_HEAD_LINES = 100
+TRUNCATED_TAIL_LINES = 50
+
+
+def create_crew_pool() -> ProcessPoolExecutor:
+    """
+    Start the crew worker processes.  Called from the app lifespan, which
+    keeps the pool on ``app.state.crew_pool`` and shuts it down on exit.
+    """
+    return ProcessPoolExecutor(
+        max_workers=CREW_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_crew_worker,
+    )
+
+
+# Pushes waiting for their CI to complete, and CI results that have been
+# handled (several completion events arrive for one result).  These
+# live in this process only; completion events also carry branch and
+# actor, so a missing pending entry is not fatal.
+_pending_pushes: TTLCache = TTLCache(maxsize=4096, ttl=6 * 3600)
+_handled_commits: TTLCache = TTLCache(maxsize=4096, ttl=6 * 3600)
+_ci_events_lock = threading.Lock()
+
+# Past-fix lookups keyed by (repo, blake2b(ci_logs)), kept for 10 minutes
+_similar_fixes_cache: TTLCache = TTLCache(maxsize=1024, ttl=600)
+_similar_fixes_lock = threading.Lock()
+
+# REST endpoints and fixed payloads used by the PR helpers
+_COMMENT_URL = API + "/repos/{repo}/issues/{pr_number}/comments"
+_PULL_URL = API + "/repos/{repo}/pulls/{pr_number}"
+_CLOSE_PAYLOAD = orjson.dumps({"state": "closed"})
 
 
 # ── Webhook signature verification ───────────────────────────────────
 
-def verify_signature(payload_body: bytes, signature_header: str | None) -> bool:
-    """Verify the GitHub webhook HMAC-SHA256 signature."""
+def verify_signature(digest: bytes, signature_header: str | None) -> bool:
+    """
+    Verify the GitHub webhook HMAC-SHA256 signature.
+
+    *digest* is the HMAC of the body, computed while it is streamed in.
+    """
     if not WEBHOOK_SECRET:
         logger.warning("GITHUB_WEBHOOK_SECRET not set — skipping verification")
         return True
-    if not signature_header:
+    # "sha256=" followed by 64 hex characters
+    if (
+        signature_header is None
+        or len(signature_header) != 71
+        or not signature_header.startswith("sha256=")
+    ):
         return False
-    expected = "sha256=" + hmac.new(
-        WEBHOOK_SECRET.encode(), payload_body, hashlib.sha256
-    ).hexdigest()
-    return hmac.compare_digest(expected, signature_header)
+    try:
+        received = bytes.fromhex(signature_header[7:])
+    except ValueError:
+        return False
+    return hmac.compare_digest(digest, received)
 
 
 # ── Helpers ──────────────────────────────────────────────────────────
 
+# One ===FILE: path=== … ===END FILE=== block.  The path cannot span lines
+# or contain "=", which keeps a match from running across block boundaries.
+_FILE_BLOCK_RE = re.compile(
+    r"===FILE:[ \t]*([^\r\n=]+?)[ \t]*===\r?\n(.*?)===END FILE===", re.DOTALL
+)
+
+
 def parse_file_changes(crew_output: str) -> list[dict]:
     """
     Extract file changes from the crew output.
@@ -52,9 +134,7 @@ def parse_file_changes(crew_output: str) -> list[dict]:
     """
     changes: list[dict] = []
 
-    for match in re.finditer(
-        r"===FILE:\s*(.+?)\s*===\n(.*?)===END FILE===", crew_output, re.DOTALL
-    ):
+    for match in _FILE_BLOCK_RE.finditer(crew_output):
         path, content = match.group(1).strip(), match.group(2).strip()
         if path and content:
             changes.append({"path": path, "content": content})
@@ -64,7 +144,11 @@ def parse_file_changes(crew_output: str) -> list[dict]:
 
     # Fallback: JSON  {"files": [{"path": …, "content": …}, …]}
     try:
-        parsed = json.loads(crew_output)
+        try:
+            parsed = orjson.loads(crew_output)
+        except orjson.JSONDecodeError:
+            # stdlib json tolerates a few inputs orjson rejects
+            parsed = json.loads(crew_output)
         if isinstance(parsed, dict) and "files" in parsed:
             for f in parsed["files"]:
                 changes.append({"path": f["path"], "content": f["content"]})
@@ -74,12 +158,200 @@ def parse_file_changes(crew_output: str) -> list[dict]:
     return changes
 
 
+def _collect_ci_logs(github: GitHubService, repo: str, failed_runs: list[dict]) -> str:
+    """
+    Download the failure logs of *failed_runs* concurrently, on one
+    async HTTP/2 client.
+
+    Only the latest run of each workflow is fetched — repeated runs of the
+    same workflow on one commit almost always fail the same way.  A run
+    whose logs cannot be fetched is skipped without aborting the others.
+    """
+    latest: dict = {}
+    for run in failed_runs:
+        key = run.get("workflow_id") or run.get("name")
+        if key not in latest or run["id"] > latest[key]["id"]:
+            latest[key] = run
+    runs = sorted(latest.values(), key=lambda r: r["id"])
+
+    try:
+        run_logs = github.get_logs_for_runs(repo, [run["id"] for run in runs])
+    except Exception as exc:
+        logger.warning("Could not fetch CI logs for %s: %s", repo, exc)
+        run_logs = [None] * len(runs)
+
+    log_parts: list[str] = []
+    for run, logs in zip(runs, run_logs):
+        if logs:
+            log_parts.append(
+                f"## Workflow: {run['name']}  (run {run['id']})\n"
+                f"URL: {run['html_url']}\n\n{logs}"
+            )
+
+    return "\n\n".join(log_parts) if log_parts else "No detailed failure logs available"
+
+
+def _crew_task_hash(repo: str, head_sha: str, inputs: dict) -> str:
+    """Hash everything the crew sees for a push, for the crew result cache."""
+    h = hashlib.blake2b(digest_size=32)
+    for part in (repo, head_sha, inputs["ci_logs"], inputs["file_tree"], inputs["source_code"]):
+        h.update(part.encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def _search_similar_fixes(es: ElasticsearchService, repo: str, ci_logs: str) -> list[dict]:
+    """
+    ``es.search_similar_fixes`` behind a short-lived cache keyed by repo and
+    a hash of the logs, so retries of the same failure skip the ES query.
+    Empty results are not cached — they may come from an ES outage.
+    """
+    key = (repo, hashlib.blake2b(ci_logs.encode(), digest_size=16).digest())
+    with _similar_fixes_lock:
+        cached = _similar_fixes_cache.get(key)
+    if cached is not None:
+        return cached
+
+    similar = es.search_similar_fixes(ci_logs, repo=repo, top_k=3)
+    if similar:
+        with _similar_fixes_lock:
+            _similar_fixes_cache[key] = similar
+    return similar
+
+
+def _source_priority(path: str) -> int:
+    """Rank a file for the source budget: code and CI workflows first, then config, then markup."""
+    if path.startswith(".github/workflows/"):
+        return 0
+    ext = os.path.splitext(path)[1].lower()
+    if ext in _CONFIG_EXTENSIONS:
+        return 1
+    if ext in _MARKUP_EXTENSIONS:
+        return 2
+    return 0
+
+
+def _is_generated_file(path: str) -> bool:
+    """Lockfiles, minified bundles and vendored/build output — no signal for the crew."""
+    name = path.rpartition("/")[2]
+    if name in _LOCKFILE_NAMES or ".min." in name:
+        return True
+    return any(f"/{d}/" in f"/{path}" for d in _GENERATED_DIRS)
+
+
+def _truncate_middle(content: str) -> str:
+    """Keep the head and tail of a long file (imports/definitions and the usual error sites)."""
+    lines = content.splitlines()
+    head, tail = TRUNCATED_HEAD_LINES, TRUNCATED_TAIL_LINES
+    if len(lines) <= head + tail:
+        return content
+    omitted = len(lines) - head - tail
+    return "\n".join(
+        lines[:head] + [f"... ({omitted} lines omitted) ..."] + lines[-tail:]
+    )
+
+
+def _looks_minified(content: str) -> bool:
+    """Heuristic: generated/minified text has very long average lines."""
+    return len(content) > 2_000 and len(content) / (content.count("\n") + 1) > 500
+
+
+def _select_source_files(repo_files: list[dict]) -> list[dict]:
+    """
+    Choose which files to download for the crew before fetching anything.
+
+    Files are ordered by ``(priority, size)`` and picked greedily while the
+    tree-reported sizes fit in ``MAX_SOURCE_CHARS`` plus 20% slack, so we
+    don't download content only to drop it at the budget check.
+    """
+    budget = int(MAX_SOURCE_CHARS * 1.2)
+    ranked = sorted(
+        (
+            f for f in repo_files
+            if f.get("size", 0) <= 50_000 and not _is_generated_file(f["path"])
+        ),
+        key=lambda f: (_source_priority(f["path"]), f.get("size", 0)),
+    )
+
+    selected: list[dict] = []
+    total = 0
+    for f in ranked:
+        size = f.get("size", 0)
+        if total + size > budget:
+            continue
+        selected.append(f)
+        total += size
+    return selected
+
+
+def _fetch_source_code(
+    github: GitHubService, repo: str, repo_files: list[dict], ref: str
+) -> str:
+    """
+    Fetch the contents of the files picked by ``_select_source_files`` and
+    concatenate them up to ``MAX_SOURCE_CHARS``.
+
+    Contents come from batched GraphQL queries (one request per hundred
+    files).  Anything GraphQL didn't return is fetched over REST in a
+    thread pool of ``SOURCE_FETCH_WORKERS`` to stay inside GitHub's
+    secondary rate limits.  Output follows the selection order.
+    """
+    paths = [f["path"] for f in _select_source_files(repo_files)]
+    try:
+        contents = github.get_files_content(repo, paths, ref=ref)
+    except Exception as exc:
+        logger.warning("GraphQL file fetch failed, falling back to REST: %s", exc)
+        contents = {}
+
+    missing = [p for p in paths if p not in contents]
+    if missing:
+        def fetch(path: str) -> str | None:
+            try:
+                return github.get_file_content(repo, path, ref=ref)
+            except Exception as exc:
+                logger.warning("Could not fetch %s: %s", path, exc)
+                return None
+
+        with ThreadPoolExecutor(max_workers=SOURCE_FETCH_WORKERS) as executor:
+            for path, content in zip(missing, executor.map(fetch, missing)):
+                if content:
+                    contents[path] = content
+
+    # Written straight into one buffer instead of building "--- path ---\n…"
+    # strings and joining them, which briefly held the source twice
+    buf = io.StringIO()
+    total_len = 0
+    for path in paths:
+        if total_len >= MAX_SOURCE_CHARS:
+            break
+        content = contents.get(path)
+        if not content or _looks_minified(content):
+            continue
+        header = f"--- {path} ---\n"
+        if total_len + len(header) + len(content) > MAX_SOURCE_CHARS:
+            # Doesn't fit whole — send its head and tail rather than all of it
+            shortened = _truncate_middle(content)
+            if shortened is not content:
+                content = shortened
+                header = f"--- {path} (truncated) ---\n"
+        if total_len:
+            buf.write("\n\n")
+        buf.write(header)
+        buf.write(content)
+        total_len += len(header) + len(content)
+
+    return buf.getvalue()
+
+
 # ── Background pipeline ─────────────────────────────────────────────
 
-def process_push(repo: str, head_sha: str, branch: str, pusher: str):
+def process_push(state: State, repo: str, head_sha: str, branch: str, pusher: str):
     """
-    Called in the background after every push.
-    Now creates a per-repo GitHubService (with installation token).
+    Called in the background after a push when ``CI_TRIGGER=poll``.
+    Polls GitHub until CI finishes, then handles the result.
+
+    *state* is ``app.state``, holding the ``es`` service and ``crew_pool``
+    created in the app lifespan.
     """
     logger.info(
         "Processing push — repo=%s  sha=%s  branch=%s  pusher=%s",
@@ -91,6 +363,70 @@ def process_push(repo: str, head_sha: str, branch: str, pusher: str):
 
     # Step 1 — Wait for CI to complete
     ci_result = github.wait_for_ci(repo, head_sha)
+    _handle_ci_result(state, github, repo, head_sha, branch, pusher, ci_result)
+
+
+def _ci_result_key(repo: str, head_sha: str, ci_result: dict) -> tuple:
+    """
+    Dedup key for a CI result of *head_sha*.
+
+    A failure is identified by its failed runs and their attempts, so runs
+    that finish later without failing don't trigger a second fix, while a
+    re-run that fails again does.  A success is identified by every run's
+    attempt, so a passing re-run after a failure still closes the fix PR.
+    """
+    status = ci_result["status"]
+    runs = ci_result["all_runs"]
+    if status == "failure":
+        failed_ids = {r["id"] for r in ci_result["failed_runs"]}
+        runs = [r for r in runs if r["id"] in failed_ids]
+    # Re-running a workflow keeps its run id and bumps run_attempt
+    return (repo, head_sha, status, frozenset((r["id"], r.get("run_attempt", 1)) for r in runs))
+
+
+def process_ci_completion(state: State, repo: str, head_sha: str, branch: str, pusher: str):
+    """
+    Called in the background when a ``workflow_run`` or ``check_suite``
+    completes (``CI_TRIGGER=events``).
+
+    Takes one snapshot of the commit's workflow runs instead of polling;
+    if some are still running and none has failed yet, the next completion
+    event picks it up.  Each distinct result is handled once (see
+    :func:`_ci_result_key`), so re-running a commit's workflows is acted on
+    again.  *state* is as for :func:`process_push`.
+    """
+    github = GitHubService.for_repo(repo)
+    ci_result = github.get_ci_status(repo, head_sha)
+    if ci_result["status"] == "no_ci":
+        logger.info("No workflow runs found for %s — skipping", head_sha[:7])
+        return
+    if ci_result["status"] == "pending":
+        logger.info("CI still running for %s — waiting for the next event", head_sha[:7])
+        return
+
+    key = _ci_result_key(repo, head_sha, ci_result)
+    with _ci_events_lock:
+        if key in _handled_commits:
+            logger.info("CI result for %s already handled — skipping", head_sha[:7])
+            return
+        _handled_commits[key] = True
+        # Prefer the push details over the event's (the event actor may be a
+        # bot); kept, not popped, so re-runs of this commit still find them
+        branch, pusher = _pending_pushes.get((repo, head_sha), (branch, pusher))
+
+    logger.info(
+        "Processing CI result — repo=%s  sha=%s  branch=%s  pusher=%s",
+        repo, head_sha[:7], branch, pusher,
+    )
+    _handle_ci_result(state, github, repo, head_sha, branch, pusher, ci_result)
+
+
+def _handle_ci_result(
+    state: State,
+    github: GitHubService, repo: str, head_sha: str, branch: str, pusher: str, ci_result: dict
+):
+    """Act on a finished CI result: close stale fix PRs on success, fix the code on failure."""
+    es: ElasticsearchService = state.es
     status = ci_result["status"]
 
     if status == "success":
@@ -123,50 +459,23 @@ def process_push(repo: str, head_sha: str, branch: str, pusher: str):
         )
 
         _comment_on_existing_pr(
-            repo, open_fix_prs[0], head_sha, failed_runs
+            github, repo, open_fix_prs[0], head_sha, failed_runs
         )
         return
 
     # Step 2 — Collect failure logs from every failed run
-    log_parts: list[str] = []
-    for run in failed_runs:
-        try:
-            run_logs = github.get_workflow_run_logs(repo, run["id"])
-            if run_logs:
-                log_parts.append(
-                    f"## Workflow: {run['name']}  (run {run['id']})\n"
-                    f"URL: {run['html_url']}\n\n{run_logs}"
-                )
-        except Exception as exc:
-            logger.warning("Could not fetch logs for run %s: %s", run["id"], exc)
-
-    ci_logs = "\n\n".join(log_parts) if log_parts else "No detailed failure logs available"
+    ci_logs = _collect_ci_logs(github, repo, failed_runs)
 
     # Step 3 — Fetch repository source code for analysis
     repo_files = github.get_repo_tree(repo, ref=default_branch)
     file_tree = "\n".join(f["path"] for f in repo_files)
 
-    source_parts: list[str] = []
-    total_len = 0
-    MAX_SOURCE_CHARS = 30_000
-
-    for f in repo_files:
-        if total_len >= MAX_SOURCE_CHARS:
-            break
-        if f.get("size", 0) > 50_000:
-            continue
-        content = github.get_file_content(repo, f["path"], ref=default_branch)
-        if content:
-            part = f"--- {f['path']} ---\n{content}"
-            total_len += len(part)
-            source_parts.append(part)
-
-    source_code = "\n\n".join(source_parts)
+    source_code = _fetch_source_code(github, repo, repo_files, ref=default_branch)
 
 
     past_fixes_text = ""
     try:
-        similar = es.search_similar_fixes(ci_logs, repo=repo, top_k=3)
+        similar = _search_similar_fixes(es, repo, ci_logs)
         if similar:
             parts: list[str] = []
             for i, fix in enumerate(similar, 1):
@@ -185,21 +494,28 @@ def process_push(repo: str, head_sha: str, branch: str, pusher: str):
         logger.warning("ES search for past fixes failed: %s", exc)
 
 
+    # Static repo context first, per-failure context last (prompt-cache prefix)
     inputs = {
-        "ci_logs": ci_logs,
         "repo_name": repo,
         "file_tree": file_tree,
         "source_code": source_code,
         "past_fixes": past_fixes_text or "No similar past fixes found.",
+        "ci_logs": ci_logs,
     }
 
-    try:
-        result = RepoPilotCrew().crew().kickoff(inputs=inputs)
-    except Exception as exc:
-        logger.error("Crew execution failed for %s: %s", head_sha[:7], exc)
-        return
+    # Webhook redeliveries and re-runs of the same failure reuse the last result
+    task_hash = _crew_task_hash(repo, head_sha, inputs)
+    crew_output = es.get_crew_result_by_hash(task_hash)
 
-    crew_output = str(result)
+    if crew_output is not None:
+        logger.info("Reusing cached crew result for %s", head_sha[:7])
+    else:
+        try:
+            crew_output = state.crew_pool.submit(run_ci_crew, inputs).result()
+        except Exception as exc:
+            logger.error("Crew execution failed for %s: %s", head_sha[:7], exc)
+            return
+        es.store_crew_result(task_hash, crew_output)
 
 
     file_changes = parse_file_changes(crew_output)
@@ -226,13 +542,15 @@ def process_push(repo: str, head_sha: str, branch: str, pusher: str):
     committed: list[str] = []
     for change in file_changes:
         try:
-            github.commit_file(
+            result = github.commit_file(
                 repo=repo,
                 branch=fix_branch,
                 file_path=change["path"],
                 content=change["content"],
                 message=f"fix: {change['path']} — auto-fix for CI failure ({head_sha[:7]})",
             )
+            if result.get("status") == "unchanged":
+                continue
             committed.append(change["path"])
         except Exception as exc:
             logger.error("Failed to commit %s: %s", change["path"], exc)
@@ -291,36 +609,51 @@ def _close_stale_fix_prs(repo: str, branch: str, reason: str):
     logger.info("Waiting for 60 minutes before closing stale PRs...")
     time.sleep(3600)  # Wait for 60 minutes
 
+    # Resolved after the wait (not passed in) so the installation token is fresh
     github = GitHubService.for_repo(repo)
     default_branch = github.get_default_branch(repo)
     open_prs = github.get_open_fix_prs(repo, base=default_branch)
+    comment = f"🤖 **RepoPilot Agent:** Closing this PR — {reason}."
+
+    # One GraphQL mutation comments on and closes every PR; REST for leftovers
+    try:
+        commented, closed = github.close_prs_with_comment(open_prs, comment)
+    except Exception as exc:
+        logger.warning("GraphQL close of stale PRs failed, falling back to REST: %s", exc)
+        commented, closed = set(), set()
+
+    # The same comment goes on every PR, so serialize it once
+    headers = {"Content-Type": "application/json"}
+    comment_payload = orjson.dumps({"body": comment})
+
     for pr in open_prs:
         pr_number = pr["number"]
+        if pr_number in closed:
+            logger.info("Closed stale fix PR #%d (%s)", pr_number, reason)
+            continue
+        url_args = {"repo": repo, "pr_number": pr_number}
         try:
-            # Add comment
-            comment_url = f"https://api.github.com/repos/{repo}/issues/{pr_number}/comments"
-            requests.post(
-                comment_url,
-                json={"body": f"🤖 **RepoPilot Agent:** Closing this PR — {reason}."},
-                headers=github.headers,
-            )
+            # Add comment, unless the GraphQL mutation already did
+            if pr_number not in commented:
+                github.session.post(
+                    _COMMENT_URL.format_map(url_args),
+                    data=comment_payload,
+                    headers=headers,
+                )
             # Close PR
-            patch_url = f"https://api.github.com/repos/{repo}/pulls/{pr_number}"
-            requests.patch(
-                patch_url,
-                json={"state": "closed"},
-                headers=github.headers,
+            github.session.patch(
+                _PULL_URL.format_map(url_args),
+                data=_CLOSE_PAYLOAD,
+                headers=headers,
             )
             logger.info("Closed stale fix PR #%d (%s)", pr_number, reason)
         except Exception as exc:
             logger.warning("Failed to close PR #%d: %s", pr_number, exc)
 
 
-
-
-def _comment_on_existing_pr(repo: str, pr: dict, head_sha: str, failed_runs: list[dict]):
-    
-    github = GitHubService.for_repo(repo)
+def _comment_on_existing_pr(
+    github: GitHubService, repo: str, pr: dict, head_sha: str, failed_runs: list[dict]
+):
     pr_number = pr["number"]
     run_summary = ", ".join(
         f"[{r['name']}]({r['html_url']})" for r in failed_runs
@@ -332,8 +665,8 @@ def _comment_on_existing_pr(repo: str, pr: dict, head_sha: str, failed_runs: lis
         f"or close it so the agent can create a new one."
     )
     try:
-        url = f"https://api.github.com/repos/{repo}/issues/{pr_number}/comments"
-        requests.post(url, json={"body": body}, headers=github.headers)
+        url = _COMMENT_URL.format_map({"repo": repo, "pr_number": pr_number})
+        github.session.post(url, json={"body": body})
         logger.info("Commented on existing fix PR #%d about new failure", pr_number)
     except Exception as exc:
         logger.warning("Failed to comment on PR #%d: %s", pr_number, exc)
@@ -344,15 +677,30 @@ def _comment_on_existing_pr(repo: str, pr: dict, head_sha: str, failed_runs: lis
 @router.post("/webhook")
 async def handle_webhook(request: Request, background_tasks: BackgroundTasks):
     """Receives GitHub webhook events with signature verification."""
-    body = await request.body()
+    event_type = request.headers.get("X-GitHub-Event", "unknown")
+    logger.info("Received GitHub event: %s", event_type)
+
+    # Unhandled events are dropped before the body is read or parsed
+    if event_type not in HANDLED_EVENTS:
+        return {
+            "status": "skipped",
+            "reason": f"Event '{event_type}' is not handled — ignoring",
+        }
+
     signature = request.headers.get("X-Hub-Signature-256")
 
-    if not verify_signature(body, signature):
+    # Hash the payload as it arrives so the body is only buffered once
+    hasher = hmac.new(WEBHOOK_SECRET_BYTES, digestmod=hashlib.sha256)
+    body = bytearray()
+    async for chunk in request.stream():
+        hasher.update(chunk)
+        body.extend(chunk)
+
+    if not verify_signature(hasher.digest(), signature):
         raise HTTPException(status_code=401, detail="Invalid webhook signature")
 
-    data = json.loads(body)
-    event_type = request.headers.get("X-GitHub-Event", "unknown")
-    logger.info("Received GitHub event: %s", event_type)
+    data = orjson.loads(body)
+    del body  # release the raw payload while the parsed copy is in use
 
     # ── Handle push events ───────────────────────────────────────────
     if event_type == "push":
@@ -374,18 +722,52 @@ async def handle_webhook(request: Request, background_tasks: BackgroundTasks):
         if head_sha == "0" * 40:
             return {"status": "skipped", "reason": "Branch deletion — ignoring"}
 
-        # Schedule the pipeline in the background
-        background_tasks.add_task(process_push, repo, head_sha, branch, pusher)
+        if CI_TRIGGER == "poll":
+            # Schedule the pipeline in the background
+            background_tasks.add_task(process_push, request.app.state, repo, head_sha, branch, pusher)
+        else:
+            # The pipeline starts when GitHub reports the CI run as completed
+            with _ci_events_lock:
+                _pending_pushes[(repo, head_sha)] = (branch, pusher)
 
         return {
             "status": "accepted",
             "message": f"Push on {repo} ({head_sha[:7]}) received — CI will be monitored",
         }
 
+    # ── Handle workflow_run events ───────────────────────────────────
+    elif event_type == "workflow_run":
+        action = data.get("action", "")
+        if action != "completed" or CI_TRIGGER == "poll":
+            return {
+                "status": "skipped",
+                "reason": f"Workflow run action '{action}' is not relevant — ignoring",
+            }
+
+        repo = data.get("repository", {}).get("full_name", "")
+        run = data.get("workflow_run", {})
+        head_sha = run.get("head_sha", "")
+        branch = run.get("head_branch", "")
+        pusher = run.get("actor", {}).get("login", "unknown")
+
+        if not repo or not head_sha:
+            raise HTTPException(
+                status_code=400,
+                detail="Could not extract repository or commit SHA from workflow_run payload",
+            )
+
+        background_tasks.add_task(process_ci_completion, request.app.state, repo, head_sha, branch, pusher)
+
+        return {
+            "status": "accepted",
+            "message": f"Workflow run on {repo} ({head_sha[:7]}) completed — checking CI result",
+        }
+
     # ── Handle check_suite events ────────────────────────────────────
     elif event_type == "check_suite":
         action = data.get("action", "")
-        if action not in {"completed", "requested"}:
+        relevant = {"completed", "requested"} if CI_TRIGGER == "poll" else {"completed"}
+        if action not in relevant:
             return {
                 "status": "skipped",
                 "reason": f"Check suite action '{action}' is not relevant — ignoring",
@@ -404,7 +786,10 @@ async def handle_webhook(request: Request, background_tasks: BackgroundTasks):
             )
 
         # Schedule the pipeline in the background
-        background_tasks.add_task(process_push, repo, head_sha, branch, pusher)
+        if CI_TRIGGER == "poll":
+            background_tasks.add_task(process_push, request.app.state, repo, head_sha, branch, pusher)
+        else:
+            background_tasks.add_task(process_ci_completion, request.app.state, repo, head_sha, branch, pusher)
 
         return {
             "status": "accepted",
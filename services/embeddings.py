@@ -0,0 +1,49 @@
+import os
+import logging
+import threading
+from dotenv import load_dotenv
+
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:  # optional — install with `pip install repopilot[vectors]`
+    SentenceTransformer = None
+
+load_dotenv()
+
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+EMBEDDING_DIMS = int(os.getenv("EMBEDDING_DIMS", "384"))  # all-MiniLM-L6-v2 output size
+
+logger = logging.getLogger(__name__)
+
+_model = None
+_model_lock = threading.Lock()
+
+
+def embeddings_enabled() -> bool:
+    """True when sentence-transformers is installed, so error vectors can be computed."""
+    return SentenceTransformer is not None
+
+
+def _get_model():
+    global _model
+    with _model_lock:
+        if _model is None:
+            logger.info("Loading embedding model '%s'", EMBEDDING_MODEL)
+            _model = SentenceTransformer(EMBEDDING_MODEL)
+        return _model
+
+
+def embed(text: str):
+    """
+    Return the L2-normalised float32 embedding of *text* as a numpy array,
+    or *None* when embeddings are not available.
+    """
+    if SentenceTransformer is None:
+        return None
+    try:
+        return _get_model().encode(
+            text, normalize_embeddings=True, convert_to_numpy=True
+        ).astype("float32")
+    except Exception as exc:
+        logger.warning("Embedding failed: %s", exc)
+        return None
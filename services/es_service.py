@@ -1,18 +1,223 @@
 import os
 import logging
-from datetime import datetime, timezone
-from elasticsearch import Elasticsearch
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from elasticsearch import Elasticsearch, NotFoundError, helpers
+from elasticsearch.serializer import OrjsonSerializer
 from dotenv import load_dotenv
 
+try:
+    import numpy as np
+except ImportError:  # only needed with the optional embeddings extra
+    np = None
+
+from services.embeddings import EMBEDDING_DIMS, embed, embeddings_enabled
+
 load_dotenv()
 
 ELASTIC_URL = os.getenv("ELASTIC_URL", "")
 ELASTIC_API_KEY = os.getenv("ELASTIC_API_KEY", "")
 ELASTIC_INDEX = os.getenv("ELASTIC_INDEX", "sage-ci-fixes")
+# Crew outputs keyed by a hash of their inputs, reused for 24 hours
+ELASTIC_CACHE_INDEX = os.getenv("ELASTIC_CACHE_INDEX", f"{ELASTIC_INDEX}-crew-cache")
+CREW_CACHE_TTL = timedelta(hours=24)
+# How often expired crew outputs are deleted from the cache index (seconds)
+CREW_CACHE_PURGE_INTERVAL = float(os.getenv("CREW_CACHE_PURGE_INTERVAL", "3600"))
+# Seconds a similar-query cache entry is served before ES is asked again
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "600"))
+# How often new fixes become searchable
+ELASTIC_REFRESH_INTERVAL = os.getenv("ELASTIC_REFRESH_INTERVAL", "30s")
+# Fixes are written in bulk once this many are queued, or every N seconds
+ES_INDEX_BATCH_SIZE = int(os.getenv("ES_INDEX_BATCH_SIZE", "100"))
+ES_FLUSH_INTERVAL = float(os.getenv("ES_FLUSH_INTERVAL", "5"))
+# HTTP connections kept open to each Elasticsearch node
+ELASTIC_CONNECTIONS = int(os.getenv("ELASTIC_CONNECTIONS", "25"))
 
 logger = logging.getLogger(__name__)
 
 
+def _quantize(vector) -> tuple:
+    """Symmetric int8 quantization of *vector*; returns ``(int8 array, scale)``."""
+    scale = float(np.abs(vector).max()) / 127.0 or 1.0
+    return np.rint(vector / scale).astype(np.int8), scale
+
+
+class SemanticCache:
+    """
+    In-process cache of past-fix search results keyed by query embedding.
+
+    A query whose (normalised) embedding has cosine similarity of at least
+    ``threshold`` with a cached one — within the same ``(repo, top_k)``
+    scope — gets the cached results without an ES round-trip.  Holds at
+    most ``max_entries`` entries, evicting the least recently used.
+    Entries expire after ``ttl`` seconds, and :meth:`invalidate_repo`
+    drops a repo's entries as soon as a new fix for it is stored.
+
+    Keys are stored int8-quantized with a per-row scale (4x smaller than
+    float32) and scanned with an int32-accumulated dot product against the
+    quantized query; only the best candidate is re-scored against the
+    float32 query before applying the threshold.
+    """
+
+    def __init__(
+        self, dims: int, max_entries: int = 1000, threshold: float = 0.95,
+        ttl: float = SEARCH_CACHE_TTL,
+    ):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stored_at = np.full(max_entries, -np.inf)
+        self.keys = np.zeros((max_entries, dims), dtype=np.int8)
+        self.scales = np.zeros(max_entries, dtype=np.float32)
+        self.scope_ids = np.zeros(max_entries, dtype=np.int32)
+        self.last_used = np.zeros(max_entries, dtype=np.int64)
+        self.values: list[list[dict] | None] = [None] * max_entries
+        self._scopes: dict[tuple, int] = {}
+        self._next_scope_id = 0
+        self._size = 0
+        self._tick = 0
+        self._lock = threading.Lock()
+
+    def get(self, query_vector, scope: tuple) -> list[dict] | None:
+        query_i8, query_scale = _quantize(query_vector)
+        with self._lock:
+            scope_id = self._scopes.get(scope)
+            if scope_id is None or self._size == 0:
+                return None
+            n = self._size
+            sims = np.einsum("nd,d->n", self.keys[:n], query_i8, dtype=np.int32)
+            sims = sims * (self.scales[:n] * query_scale)
+            sims[self.scope_ids[:n] != scope_id] = -1.0
+            sims[self.stored_at[:n] < time.monotonic() - self.ttl] = -1.0
+            best = int(sims.argmax())
+            if sims[best] < 0 or self.scope_ids[best] != scope_id:
+                return None  # nothing live cached for this scope
+            score = float(self.keys[best].astype(np.float32) @ query_vector) * self.scales[best]
+            if score < self.threshold:
+                return None
+            self._tick += 1
+            self.last_used[best] = self._tick
+            return self.values[best]
+
+    def put(self, query_vector, scope: tuple, results: list[dict]):
+        key, scale = _quantize(query_vector)
+        with self._lock:
+            scope_id = self._scopes.get(scope)
+            if scope_id is None:
+                scope_id = self._scopes[scope] = self._next_scope_id
+                self._next_scope_id += 1
+            if self._size < self.max_entries:
+                slot = self._size
+                self._size += 1
+            else:
+                slot = int(self.last_used.argmin())
+                self._forget_scope_if_last(slot, scope_id)
+            self._tick += 1
+            self.keys[slot] = key
+            self.scales[slot] = scale
+            self.scope_ids[slot] = scope_id
+            self.last_used[slot] = self._tick
+            self.stored_at[slot] = time.monotonic()
+            self.values[slot] = results
+
+    def invalidate_repo(self, repo: str):
+        """Expire every entry whose results could now miss a new fix for *repo*."""
+        with self._lock:
+            stale = [sid for scope, sid in self._scopes.items() if scope[0] in (repo, None)]
+            rows = np.isin(self.scope_ids[:self._size], stale)
+            self.stored_at[:self._size][rows] = -np.inf
+            self.last_used[:self._size][rows] = 0  # evicted first
+
+    def _forget_scope_if_last(self, slot: int, new_scope_id: int):
+        """Drop the scope of the row being evicted from *slot* if no other row uses it."""
+        old_scope_id = int(self.scope_ids[slot])
+        if old_scope_id == new_scope_id:
+            return
+        if np.count_nonzero(self.scope_ids[:self._size] == old_scope_id) == 1:
+            for scope, sid in self._scopes.items():
+                if sid == old_scope_id:
+                    del self._scopes[scope]
+                    break
+
+
+class FixBatcher:
+    """
+    Buffers fix documents and writes them with the ``_bulk`` API.
+
+    The queue is flushed when it reaches ``ES_INDEX_BATCH_SIZE`` documents
+    and every ``ES_FLUSH_INTERVAL`` seconds by a daemon thread, so N fixes
+    cost one HTTP round-trip instead of N.  The same thread deletes crew
+    outputs older than ``CREW_CACHE_TTL`` every ``CREW_CACHE_PURGE_INTERVAL``
+    seconds, since the TTL is otherwise only checked on read.
+    """
+
+    def __init__(
+        self,
+        client: Elasticsearch,
+        batch_size: int = ES_INDEX_BATCH_SIZE,
+        flush_interval: float = ES_FLUSH_INTERVAL,
+    ):
+        self.client = client
+        self.batch_size = batch_size
+        self.queue: list[dict] = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, args=(flush_interval,), name="es-fix-batcher", daemon=True
+        )
+        self._thread.start()
+
+    def add(self, doc: dict):
+        with self._lock:
+            self.queue.append({"_index": ELASTIC_INDEX, "_source": doc})
+            full = len(self.queue) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self) -> int:
+        with self._lock:
+            actions, self.queue = self.queue, []
+        if not actions:
+            return 0
+        try:
+            sent, _ = helpers.bulk(
+                self.client.options(request_timeout=60), actions, chunk_size=self.batch_size
+            )
+            logger.info("Bulk-stored %d fix(es) in ES", sent)
+            return sent
+        except Exception as exc:
+            logger.error("Failed to bulk-store %d fix(es) in ES: %s", len(actions), exc)
+            return 0
+
+    def close(self):
+        self._stop.set()
+        self._thread.join(timeout=5)
+        self.flush()
+
+    def purge_expired_crew_results(self):
+        """Delete crew cache documents past ``CREW_CACHE_TTL`` (runs as an ES task)."""
+        try:
+            self.client.delete_by_query(
+                index=ELASTIC_CACHE_INDEX,
+                query={"range": {"created_at": {
+                    "lt": f"now-{int(CREW_CACHE_TTL.total_seconds())}s"
+                }}},
+                conflicts="proceed",
+                wait_for_completion=False,
+            )
+        except Exception as exc:
+            logger.warning("Failed to purge expired crew results: %s", exc)
+
+    def _run(self, flush_interval: float):
+        next_purge = time.monotonic()
+        while not self._stop.wait(flush_interval):
+            self.flush()
+            if time.monotonic() >= next_purge:
+                self.purge_expired_crew_results()
+                next_purge = time.monotonic() + CREW_CACHE_PURGE_INTERVAL
+
+
 class ElasticsearchService:
     """
     Stores and retrieves CI/CD fix records using Elasticsearch.
@@ -37,14 +242,39 @@ class ElasticsearchService:
         }
     }
 
+    # Client-side embedding of the error text, added when embeddings are enabled
+    VECTOR_MAPPINGS = {
+        "error_vector": {
+            "type": "dense_vector",
+            "dims": EMBEDDING_DIMS,
+            "index": True,
+            "similarity": "cosine",
+        },
+    }
+
+    CACHE_INDEX_MAPPINGS = {
+        "properties": {
+            "crew_output": {"type": "text", "index": False},
+            "created_at": {"type": "date"},
+        }
+    }
+
     def __init__(self):
         if not ELASTIC_URL or not ELASTIC_API_KEY:
             logger.warning("Elasticsearch URL or API key not configured — ES features disabled")
             self.client = None
             return
 
-        self.client = Elasticsearch(ELASTIC_URL, api_key=ELASTIC_API_KEY)
+        self.client = Elasticsearch(
+            ELASTIC_URL,
+            api_key=ELASTIC_API_KEY,
+            connections_per_node=ELASTIC_CONNECTIONS,
+            serializer=OrjsonSerializer(),
+        )
         self._ensure_index()
+        self.batcher = FixBatcher(self.client)
+        # Near-duplicate queries (the same test failing again) skip ES
+        self.search_cache = SemanticCache(EMBEDDING_DIMS) if embeddings_enabled() else None
 
     # ── Index bootstrap ──────────────────────────────────────────────
 
@@ -57,11 +287,33 @@ class ElasticsearchService:
                 self.client.indices.create(index=ELASTIC_INDEX)
                 logger.info("Created Elasticsearch index '%s'", ELASTIC_INDEX)
 
+            mappings = self.INDEX_MAPPINGS
+            if embeddings_enabled():
+                mappings = {
+                    "properties": {**mappings["properties"], **self.VECTOR_MAPPINGS},
+                }
             self.client.indices.put_mapping(
                 index=ELASTIC_INDEX,
-                body=self.INDEX_MAPPINGS,
+                body=mappings,
             )
             logger.info("Elasticsearch mappings updated for '%s'", ELASTIC_INDEX)
+
+            # Fixes are only read by later searches, so a relaxed refresh
+            # interval is fine and keeps indexing cheap
+            try:
+                self.client.indices.put_settings(
+                    index=ELASTIC_INDEX,
+                    settings={"index": {"refresh_interval": ELASTIC_REFRESH_INTERVAL}},
+                )
+            except Exception as exc:
+                # e.g. serverless projects don't allow changing refresh_interval
+                logger.warning("Could not set refresh_interval on '%s': %s", ELASTIC_INDEX, exc)
+
+            if not self.client.indices.exists(index=ELASTIC_CACHE_INDEX):
+                self.client.indices.create(
+                    index=ELASTIC_CACHE_INDEX, mappings=self.CACHE_INDEX_MAPPINGS
+                )
+                logger.info("Created Elasticsearch index '%s'", ELASTIC_CACHE_INDEX)
         except Exception as exc:
             logger.error("Failed to bootstrap Elasticsearch index: %s", exc)
 
@@ -77,10 +329,16 @@ class ElasticsearchService:
         analysis: str,
         file_changes: list[dict],
         pr_url: str,
+        wait_for_visibility: bool = False,
     ) -> bool:
         """
         Index a CI fix document.  Returns True on success.
 
+        The fix is queued and written by :class:`FixBatcher` with the bulk
+        API; it becomes searchable after the next flush and refresh.  Pass
+        ``wait_for_visibility=True`` to index it directly and wait until it
+        is searchable.
+
         Parameters
         ----------
         repo : str          Owner/repo
@@ -90,6 +348,7 @@ class ElasticsearchService:
         analysis : str      AI analysis / crew output
         file_changes : list Files that were changed  [{path, content}, …]
         pr_url : str        URL of the created PR
+        wait_for_visibility : bool  Block until the document is searchable
         """
         if self.client is None:
             logger.debug("ES client not configured — skipping store_fix")
@@ -105,19 +364,74 @@ class ElasticsearchService:
             "pr_url": pr_url,
             "created_at": datetime.now(timezone.utc).isoformat(),
         }
+        vector = embed(ci_logs[:2000])
+        if vector is not None:
+            doc["error_vector"] = vector.tolist()
+        if self.search_cache is not None:
+            self.search_cache.invalidate_repo(repo)
+
+        if not wait_for_visibility:
+            self.batcher.add(doc)
+            logger.info("Queued fix for ES for %s (%s)", repo, head_sha[:7])
+            return True
 
         try:
-            self.client.index(
-                index=ELASTIC_INDEX,
-                document=doc,
-                refresh="wait_for",
-            )
+            self.client.index(index=ELASTIC_INDEX, document=doc, refresh="wait_for")
             logger.info("Stored fix in ES for %s (%s)", repo, head_sha[:7])
             return True
         except Exception as exc:
             logger.error("Failed to store fix in ES: %s", exc)
             return False
 
+    def flush(self) -> int:
+        """Write any queued fixes now.  Returns the number of documents sent."""
+        if self.client is None:
+            return 0
+        return self.batcher.flush()
+
+    def close(self):
+        """Stop the background flusher and write whatever is still queued."""
+        if self.client is not None:
+            self.batcher.close()
+
+    # ── Crew result cache ────────────────────────────────────────────
+
+    def get_crew_result_by_hash(self, task_hash: str) -> str | None:
+        """Return the crew output stored for *task_hash* if it is under 24 hours old."""
+        if self.client is None:
+            return None
+        try:
+            resp = self.client.get(index=ELASTIC_CACHE_INDEX, id=task_hash)
+        except NotFoundError:
+            return None
+        except Exception as exc:
+            logger.warning("Crew cache lookup failed: %s", exc)
+            return None
+
+        src = resp["_source"]
+        created_at = datetime.fromisoformat(src["created_at"])
+        if datetime.now(timezone.utc) - created_at > CREW_CACHE_TTL:
+            return None
+        return src.get("crew_output")
+
+    def store_crew_result(self, task_hash: str, crew_output: str) -> bool:
+        """Store a crew output under *task_hash*.  Returns True on success."""
+        if self.client is None:
+            return False
+        try:
+            self.client.index(
+                index=ELASTIC_CACHE_INDEX,
+                id=task_hash,
+                document={
+                    "crew_output": crew_output,
+                    "created_at": datetime.now(timezone.utc).isoformat(),
+                },
+            )
+            return True
+        except Exception as exc:
+            logger.warning("Failed to store crew result in ES: %s", exc)
+            return False
+
     # ── Search for similar past fixes ────────────────────────────────
 
     def search_similar_fixes(self, error_text: str, repo: str | None = None, top_k: int = 3) -> list[dict]:
@@ -125,58 +439,78 @@ class ElasticsearchService:
         Semantic search for past fixes whose ``error_text`` is similar to
         the current failure logs.
 
+        When embeddings are enabled the query is embedded locally and run
+        as a kNN search on ``error_vector``, so ES doesn't re-run inference
+        per query.  Otherwise (or when kNN finds nothing, e.g. for fixes
+        stored before vectors existed) it falls back to a ``semantic``
+        query on ``error_text``.
+
         Returns up to *top_k* results, each a dict with keys:
         ``repo, branch, head_sha, analysis, file_changes, pr_url, score``.
         """
         if self.client is None:
             return []
 
-        # Build retriever using semantic search on the error_text field
-        retriever = {
-            "standard": {
-                "query": {
-                    "semantic": {
-                        "field": "error_text",
-                        "query": error_text[:2000],   # trim to stay within limits
-                    }
-                }
-            }
-        }
-
-        # Optionally boost results from the same repo
-        filter_clauses = []
-        if repo:
-            filter_clauses.append({"term": {"repo": repo}})
+        query_text = error_text[:2000]   # trim to stay within limits
 
         try:
-            if filter_clauses:
-                resp = self.client.search(
-                    index=ELASTIC_INDEX,
-                    retriever=retriever,
-                    post_filter={"bool": {"should": filter_clauses}},
-                    size=top_k,
-                )
-            else:
-                resp = self.client.search(
-                    index=ELASTIC_INDEX,
-                    retriever=retriever,
-                    size=top_k,
-                )
+            query_vector = embed(query_text)
+            if query_vector is not None:
+                scope = (repo, top_k)
+                cached = self.search_cache.get(query_vector, scope)
+                if cached is not None:
+                    return cached
 
-            results: list[dict] = []
-            for hit in resp["hits"]["hits"]:
-                src = hit["_source"]
-                results.append({
-                    "repo": src.get("repo", ""),
-                    "branch": src.get("branch", ""),
-                    "head_sha": src.get("head_sha", ""),
-                    "analysis": src.get("analysis", ""),
-                    "file_changes": src.get("file_changes", []),
-                    "pr_url": src.get("pr_url", ""),
-                    "score": hit.get("_score", 0),
-                })
-            return results
+                knn = {
+                    "field": "error_vector",
+                    "query_vector": query_vector.tolist(),
+                    "k": top_k,
+                    "num_candidates": 50,
+                }
+                if repo:
+                    knn["filter"] = {"term": {"repo": repo}}
+                resp = self.client.search(index=ELASTIC_INDEX, knn=knn, size=top_k)
+                if resp["hits"]["hits"]:
+                    results = self._format_hits(resp)
+                    self.search_cache.put(query_vector, scope, results)
+                    return results
+
+            # Semantic search on error_text, pre-filtered to the same repo so
+            # ES only scores that repo's fixes instead of the whole corpus
+            retriever = {
+                "standard": {
+                    "query": {
+                        "bool": {
+                            "must": [{
+                                "semantic": {
+                                    "field": "error_text",
+                                    "query": query_text,
+                                }
+                            }],
+                            "filter": [{"term": {"repo": repo}}] if repo else [],
+                        }
+                    }
+                }
+            }
+            resp = self.client.search(index=ELASTIC_INDEX, retriever=retriever, size=top_k)
+            return self._format_hits(resp)
 
         except Exception as exc:
             logger.warning("Elasticsearch search failed: %s", exc)
             return []
+
+    @staticmethod
+    def _format_hits(resp) -> list[dict]:
+        results: list[dict] = []
+        for hit in resp["hits"]["hits"]:
+            src = hit["_source"]
+            results.append({
+                "repo": src.get("repo", ""),
+                "branch": src.get("branch", ""),
+                "head_sha": src.get("head_sha", ""),
+                "analysis": src.get("analysis", ""),
+                "file_changes": src.get("file_changes", []),
+                "pr_url": src.get("pr_url", ""),
+                "score": hit.get("_score", 0),
+            })
+        return results
@@ -0,0 +1,367 @@
+import asyncio
+import os
+import logging
+import random
+import time
+from collections import deque
+from typing import Any
+import httpx
+import orjson
+from dotenv import load_dotenv
+from services.github_auth import API
+from services.github_http import GRAPHQL_URL, etag_lookup, graphql_data, resolve_conditional
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# How long we wait for CI to finish (seconds)
+CI_POLL_TIMEOUT = int(os.getenv("CI_POLL_TIMEOUT", "600"))  # 10 min default
+# Poll delay backs off from the min to the max while nothing changes.  The
+# older CI_POLL_INTERVAL setting, if present, is taken as the minimum.
+CI_POLL_MIN_INTERVAL = float(
+    os.getenv("CI_POLL_MIN_INTERVAL", os.getenv("CI_POLL_INTERVAL", "5"))
+)
+CI_POLL_MAX_INTERVAL = float(os.getenv("CI_POLL_MAX_INTERVAL", "60"))
+CI_POLL_BACKOFF = 1.5
+# Give up early if no GitHub Actions check suite shows up for the commit
+CI_NO_ACTIONS_GRACE = 60
+
+# Run conclusions that count as a CI failure
+FAILED_CONCLUSIONS = ("failure", "timed_out", "cancelled")
+
+# Concurrent job-log downloads per client, across all runs
+JOB_LOG_WORKERS = int(os.getenv("JOB_LOG_WORKERS", "8"))
+# Bytes of each job log to download; we only keep the last 6000 chars
+LOG_TAIL_BYTES = 8192
+
+# Check suites of a commit with their Actions workflow runs, so one query
+# replaces the REST runs + check-suites pair on every CI poll
+_CI_STATUS_QUERY = """
+query($owner: String!, $name: String!, $sha: GitObjectID!) {
+  repository(owner: $owner, name: $name) {
+    object(oid: $sha) {
+      ... on Commit {
+        checkSuites(first: 50) {
+          nodes {
+            status
+            conclusion
+            app { slug }
+            workflowRun { databaseId url updatedAt workflow { name databaseId } }
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+
+def has_failed_run(runs: list[dict]) -> bool:
+    """True when any run in *runs* has already concluded unsuccessfully."""
+    return any(r.get("conclusion") in FAILED_CONCLUSIONS for r in runs)
+
+
+def summarize_completed_runs(head_sha: str, runs: list[dict], partial: bool = False) -> dict:
+    """
+    Build the CI result dict for a commit whose workflow runs have completed.
+
+    With *partial* set, some runs are still going but one has already
+    failed (see ``fail_fast`` on :meth:`AsyncGitHubService.wait_for_ci`);
+    the result then carries ``"partial": True``.
+    """
+    failed = [
+        {
+            "id": r["id"],
+            "workflow_id": r.get("workflow_id"),
+            "name": r.get("name", ""),
+            "html_url": r.get("html_url", ""),
+            "conclusion": r.get("conclusion", ""),
+        }
+        for r in runs
+        if r.get("conclusion") in FAILED_CONCLUSIONS
+    ]
+    status = "failure" if failed else "success"
+    logger.info(
+        "CI %s for %s — %s (%d runs, %d failed)",
+        "failed early" if partial else "completed",
+        head_sha[:7], status, len(runs), len(failed),
+    )
+    result = {"status": status, "failed_runs": failed, "all_runs": runs}
+    if partial:
+        result["partial"] = True
+    return result
+
+
+class AsyncGitHubService:
+    """
+    Async counterpart of :class:`GitHubService` for the CI poll loop and
+    log fan-out, where requests are independent and mostly waiting.
+
+    Use as an async context manager so the HTTP/2 connection pool is
+    closed afterwards::
+
+        async with AsyncGitHubService(github.headers) as gh:
+            result = await gh.wait_for_ci(repo, head_sha)
+    """
+
+    def __init__(self, headers: dict):
+        self.headers = headers
+        self.client: httpx.AsyncClient | None = None
+
+    async def __aenter__(self) -> "AsyncGitHubService":
+        self.client = httpx.AsyncClient(
+            headers=self.headers,
+            http2=True,
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+            timeout=httpx.Timeout(30.0),
+            follow_redirects=True,  # job logs redirect to blob storage
+        )
+        self._job_log_limit = asyncio.Semaphore(JOB_LOG_WORKERS)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.client.aclose()
+
+    async def _conditional_get(self, url: str, params: dict | None = None) -> tuple[int, Any]:
+        """GET *url* revalidating against the shared ETag cache; see :func:`resolve_conditional`."""
+        key, cached, headers = etag_lookup(url, params)
+        resp = await self.client.get(url, params=params, headers=headers)
+        return resolve_conditional(key, cached, resp.status_code, resp.headers, resp.content)
+
+    async def _graphql(self, query: str, variables: dict, allow_errors: bool = True) -> dict | None:
+        """POST a GraphQL query and return its ``data``, or *None* on failure."""
+        resp = await self.client.post(GRAPHQL_URL, json={"query": query, "variables": variables})
+        return graphql_data(resp.status_code, resp.content, allow_errors=allow_errors)
+
+    # ── CI / CD polling & logs ─────────────────────────────────────
+
+    async def _poll_ci_status(self, repo: str, head_sha: str) -> tuple[list[dict], list[dict]] | None:
+        """
+        Fetch a commit's workflow runs and check suites in one GraphQL query.
+
+        Returns ``(runs, suites)`` shaped like the REST responses — runs
+        carry ``id, workflow_id, name, html_url, status, conclusion,
+        updated_at`` and suites carry ``app.slug`` — or *None* when the
+        answer can't be trusted to be complete (query errors, unreadable
+        check suites, or an Actions suite without its workflow run), so the
+        caller falls back to REST instead of mistaking it for "no CI".
+        """
+        owner, _, name = repo.partition("/")
+        data = await self._graphql(
+            _CI_STATUS_QUERY, {"owner": owner, "name": name, "sha": head_sha},
+            allow_errors=False,
+        )
+        commit = ((data or {}).get("repository") or {}).get("object")
+        if commit is None:
+            return None
+        check_suites = commit.get("checkSuites")
+        if check_suites is None:
+            return None
+
+        runs: list[dict] = []
+        suites: list[dict] = []
+        for node in check_suites.get("nodes") or []:
+            app = node.get("app") or {}
+            suites.append({"app": app})
+            run = node.get("workflowRun")
+            if not run:
+                if app.get("slug") == "github-actions":
+                    return None
+                continue
+            workflow = run.get("workflow") or {}
+            runs.append({
+                "id": run["databaseId"],
+                "workflow_id": workflow.get("databaseId"),
+                "name": workflow.get("name", ""),
+                "html_url": run.get("url", ""),
+                "status": (node.get("status") or "").lower(),
+                "conclusion": (node.get("conclusion") or "").lower() or None,
+                "updated_at": run.get("updatedAt"),
+            })
+        return runs, suites
+
+    async def get_workflow_runs_for_commit(self, repo: str, head_sha: str) -> list[dict]:
+        """Return all workflow runs triggered for a specific commit SHA."""
+        url = f"{API}/repos/{repo}/actions/runs"
+        status, data = await self._conditional_get(
+            url, params={"head_sha": head_sha, "per_page": 20}
+        )
+        if status != 200:
+            logger.warning("Failed to list workflow runs for %s: %s", head_sha, status)
+            return []
+        return data.get("workflow_runs", [])
+
+    async def get_check_suites_for_commit(self, repo: str, head_sha: str) -> list[dict]:
+        """Return all check suites for a specific commit SHA."""
+        url = f"{API}/repos/{repo}/commits/{head_sha}/check-suites"
+        status, data = await self._conditional_get(url)
+        if status != 200:
+            logger.warning("Failed to list check suites for %s: %s", head_sha, status)
+            return []
+        return data.get("check_suites", [])
+
+    async def wait_for_ci(
+        self, repo: str, head_sha: str,
+        timeout: int | None = None, interval: float | None = None,
+        fail_fast: bool = True,
+    ) -> dict:
+        """
+        Poll GitHub until every CI workflow run for *head_sha* has completed.
+
+        With *fail_fast* (the default) we return as soon as any run has
+        failed, without waiting for slower runs; such results are marked
+        ``"partial": True`` and ``all_runs`` may include unfinished runs.
+
+        Workflow runs and check suites are fetched together with one
+        GraphQL query per poll (falling back to the two REST calls if it
+        fails); when no GitHub Actions suite exists for the commit we stop
+        after ``CI_NO_ACTIONS_GRACE`` seconds instead of the full timeout.
+
+        The delay between polls starts at *interval* (default
+        ``CI_POLL_MIN_INTERVAL``) and grows by ``CI_POLL_BACKOFF`` up to
+        ``CI_POLL_MAX_INTERVAL`` while the runs are unchanged, dropping
+        back to the floor whenever a run is added or changes state.  Each
+        delay gets ±20% jitter so concurrent waits don't poll in lockstep.
+
+        Returns a dict::
+
+            {
+                "status": "failure" | "success" | "timeout" | "no_ci",
+                "failed_runs": [ {id, workflow_id, name, html_url, conclusion}, … ],
+                "all_runs":    [ … ],
+                "partial":     True,   # only on a fail-fast return
+            }
+        """
+        timeout = timeout or CI_POLL_TIMEOUT
+        floor = interval or CI_POLL_MIN_INTERVAL
+        delay = floor
+        last_progress = None
+        started = time.time()
+        deadline = started + timeout
+
+        logger.info("Waiting for CI on %s commit %s (timeout %ss)", repo, head_sha[:7], timeout)
+
+        # Give GitHub a moment to register the workflow runs
+        await asyncio.sleep(min(10, floor))
+
+        while True:
+            polled = await self._poll_ci_status(repo, head_sha)
+            if polled is None:
+                polled = await asyncio.gather(
+                    self.get_workflow_runs_for_commit(repo, head_sha),
+                    self.get_check_suites_for_commit(repo, head_sha),
+                )
+            runs, suites = polled
+
+            progress = frozenset(
+                (r.get("id"), r.get("status"), r.get("updated_at")) for r in runs
+            )
+            if progress != last_progress:
+                delay = floor
+                last_progress = progress
+            else:
+                delay = min(delay * CI_POLL_BACKOFF, CI_POLL_MAX_INTERVAL)
+            sleep_for = delay * random.uniform(0.8, 1.2)
+
+            if not runs:
+                # No workflow runs found yet — could still be spinning up
+                has_actions = any(
+                    (s.get("app") or {}).get("slug") == "github-actions" for s in suites
+                )
+                no_actions_expired = (
+                    not has_actions and time.time() >= started + CI_NO_ACTIONS_GRACE
+                )
+                if time.time() >= deadline or no_actions_expired:
+                    logger.info("No CI workflow runs found for %s", head_sha[:7])
+                    return {"status": "no_ci", "failed_runs": [], "all_runs": []}
+                await asyncio.sleep(sleep_for)
+                continue
+
+            all_completed = all(r.get("status") == "completed" for r in runs)
+
+            if all_completed:
+                return summarize_completed_runs(head_sha, runs)
+
+            if fail_fast and has_failed_run(runs):
+                return summarize_completed_runs(head_sha, runs, partial=True)
+
+            if time.time() >= deadline:
+                logger.warning("CI poll timeout for %s", head_sha[:7])
+                return {"status": "timeout", "failed_runs": [], "all_runs": runs}
+
+            pending = sum(1 for r in runs if r.get("status") != "completed")
+            logger.debug("CI not done — %d pending runs, retrying in %.0fs", pending, sleep_for)
+            await asyncio.sleep(sleep_for)
+
+    async def get_workflow_run_logs(self, repo: str, run_id: int) -> str:
+        """Fetch the plain-text logs of every *failed* job in a workflow run."""
+        jobs_url = f"{API}/repos/{repo}/actions/runs/{run_id}/jobs"
+        resp = await self.client.get(jobs_url)
+
+        if resp.status_code != 200:
+            logger.warning("Failed to fetch jobs for run %s: %s", run_id, resp.status_code)
+            return ""
+
+        jobs = orjson.loads(resp.content).get("jobs", [])
+        failed_jobs = [j for j in jobs if j.get("conclusion") == "failure"]
+
+        async def fetch(job: dict) -> str | None:
+            async with self._job_log_limit:
+                return await self._fetch_job_log(repo, job)
+
+        results = await asyncio.gather(*(fetch(job) for job in failed_jobs))
+        all_logs = [block for block in results if block]
+        return "\n\n".join(all_logs) if all_logs else "No failure logs available"
+
+    async def get_logs_for_runs(self, repo: str, run_ids: list[int]) -> list[str | None]:
+        """
+        Fetch :meth:`get_workflow_run_logs` for every run in *run_ids* at once.
+
+        Returns the logs in *run_ids* order; a run whose logs could not be
+        fetched is *None* rather than failing the rest.
+        """
+        results = await asyncio.gather(
+            *(self.get_workflow_run_logs(repo, run_id) for run_id in run_ids),
+            return_exceptions=True,
+        )
+        logs: list[str | None] = []
+        for run_id, result in zip(run_ids, results):
+            if isinstance(result, Exception):
+                logger.warning("Could not fetch logs for run %s: %s", run_id, result)
+                result = None
+            logs.append(result)
+        return logs
+
+    async def _fetch_job_log(self, repo: str, job: dict) -> str | None:
+        """Download one job's log and return its formatted tail, or *None* on failure."""
+        job_id = job["id"]
+        job_name = job.get("name", "unknown")
+        log_url = f"{API}/repos/{repo}/actions/jobs/{job_id}/logs"
+        tail: deque[bytes] = deque()
+        tail_size = 0
+
+        # Logs redirect to blob storage, which honours Range — ask for the
+        # tail only.  If the range is ignored (200), stream and keep the tail.
+        async with self.client.stream(
+            "GET", log_url, headers={"Range": f"bytes=-{LOG_TAIL_BYTES}"}
+        ) as log_resp:
+            if log_resp.status_code not in (200, 206):
+                logger.warning("Failed to fetch logs for job %s: %s", job_id, log_resp.status_code)
+                return None
+            # A 206 starting at byte 0 means the whole log fit in the range
+            truncated = log_resp.status_code == 206 and not log_resp.headers.get(
+                "Content-Range", ""
+            ).startswith("bytes 0-")
+            async for chunk in log_resp.aiter_bytes():
+                tail.append(chunk)
+                tail_size += len(chunk)
+                while tail_size - len(tail[0]) >= LOG_TAIL_BYTES:
+                    tail_size -= len(tail.popleft())
+                    truncated = True
+
+        text = b"".join(tail).decode("utf-8", errors="replace")
+        # Keep the tail — errors are almost always at the end
+        if truncated or len(text) > 6000:
+            text = "...(truncated)...\n" + text[-6000:]
+        return f"=== Job: {job_name} (id {job_id}) ===\n{text}"
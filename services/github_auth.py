@@ -1,8 +1,14 @@
 import os
 import time
+import threading
+from datetime import datetime
 import logging
 import jwt
+import orjson
 import requests
+from cachetools import TTLCache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -10,24 +16,91 @@ load_dotenv()
 GITHUB_APP_ID = os.getenv("GITHUB_APP_ID")
 GITHUB_PRIVATE_KEY_PATH = os.getenv("GITHUB_PRIVATE_KEY_PATH", "./sage-app.pem")
 
+# GitHub REST/GraphQL API root, shared by every service module
+API = "https://api.github.com"
+
 logger = logging.getLogger(__name__)
 
 
+def build_session(pool_connections: int = 20, pool_maxsize: int = 50) -> requests.Session:
+    """
+    Return a ``requests.Session`` with a pooled, retrying HTTPS adapter.
+
+    Reusing connections saves a TCP + TLS handshake per GitHub call.
+    429/5xx responses are retried with backoff (honouring Retry-After) for
+    idempotent methods; PATCH is included since we only use it to close PRs.
+    When retries are exhausted the final response is returned, not raised.
+    """
+    session = requests.Session()
+    session.mount(
+        "https://",
+        HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.5,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"PATCH"},
+                respect_retry_after_header=True,
+                # Hand back the last response so callers' status checks
+                # still pick their fallbacks once retries run out
+                raise_on_status=False,
+            ),
+        ),
+    )
+    return session
+
+
+_SESSION = build_session()
+
+# Installation tokens live 1 hour.  Only hand out a cached one with at
+# least 55 min left, so a newly built GitHubService starts near full life.
+INSTALLATION_TOKEN_MIN_TTL = 3300
+
+# Private key contents, the current App JWT as (token, exp), and
+# installation tokens as {installation_id: (token, expires_at)}
+_KEY_CACHE: str | None = None
+_JWT_CACHE: tuple[str, int] | None = None
+_installation_tokens: dict[int, tuple[str, float]] = {}
+# Installation id per owner; refreshed hourly in case the App is reinstalled
+INSTALLATION_ID_TTL = 3600
+_installation_ids: TTLCache = TTLCache(maxsize=256, ttl=INSTALLATION_ID_TTL)
+_cache_lock = threading.Lock()
+
+
 def _load_private_key() -> str:
-    with open(GITHUB_PRIVATE_KEY_PATH, "r") as f:
-        return f.read()
+    global _KEY_CACHE
+    if _KEY_CACHE is None:
+        with open(GITHUB_PRIVATE_KEY_PATH, "r") as f:
+            _KEY_CACHE = f.read()
+    return _KEY_CACHE
 
 
 def generate_jwt() -> str:
-    """Generate a short-lived JWT to authenticate as the GitHub App."""
+    """
+    Return a short-lived JWT to authenticate as the GitHub App.
+
+    The token is valid for 10 minutes and reused until it has less than
+    a minute left, so most calls skip the RSA signature.
+    """
+    global _JWT_CACHE
     now = int(time.time())
+    with _cache_lock:
+        if _JWT_CACHE is not None and _JWT_CACHE[1] - now > 60:
+            return _JWT_CACHE[0]
+
+    exp = now + (10 * 60)   # expires in 10 minutes
     payload = {
         "iat": now - 60,          # issued at (60s clock drift allowance)
-        "exp": now + (10 * 60),   # expires in 10 minutes
+        "exp": exp,
         "iss": GITHUB_APP_ID,
     }
     private_key = _load_private_key()
-    return jwt.encode(payload, private_key, algorithm="RS256")
+    token = jwt.encode(payload, private_key, algorithm="RS256")
+    with _cache_lock:
+        _JWT_CACHE = (token, exp)
+    return token
 
 
 def get_installation_token(installation_id: int) -> str:
@@ -35,31 +108,72 @@ def get_installation_token(installation_id: int) -> str:
     Exchange the App JWT for a short-lived installation access token.
     This token is scoped to the repos where the App is installed.
     """
+    return get_installation_token_with_expiry(installation_id)[0]
+
+
+def get_installation_token_with_expiry(installation_id: int) -> tuple[str, float]:
+    """
+    Like :func:`get_installation_token`, also returning the token's expiry
+    as a Unix timestamp.
+
+    Tokens are cached per installation while they have more than
+    ``INSTALLATION_TOKEN_MIN_TTL`` seconds left.
+    """
+    now = time.time()
+    with _cache_lock:
+        cached = _installation_tokens.get(installation_id)
+        if cached is not None and cached[1] - now > INSTALLATION_TOKEN_MIN_TTL:
+            return cached
+
     app_jwt = generate_jwt()
-    url = f"https://api.github.com/app/installations/{installation_id}/access_tokens"
-    resp = requests.post(
+    url = f"{API}/app/installations/{installation_id}/access_tokens"
+    resp = _SESSION.post(
         url,
         headers={
             "Authorization": f"Bearer {app_jwt}",
             "Accept": "application/vnd.github+json",
         },
     )
+    if resp.status_code == 404:
+        # Installation is gone (uninstalled or reinstalled) — look it up again next time
+        with _cache_lock:
+            for owner in [o for o, i in _installation_ids.items() if i == installation_id]:
+                del _installation_ids[owner]
     if resp.status_code != 201:
         raise Exception(f"Failed to get installation token: {resp.status_code} {resp.text}")
-    return resp.json()["token"]
+
+    data = orjson.loads(resp.content)
+    expires_at = datetime.fromisoformat(data["expires_at"]).timestamp()
+    with _cache_lock:
+        _installation_tokens[installation_id] = (data["token"], expires_at)
+    return data["token"], expires_at
 
 
 def get_installation_id_for_repo(repo: str) -> int:
     """Find the installation ID for a given owner/repo."""
+    return _installation_id_for_owner(repo.partition("/")[0])
+
+
+def _installation_id_for_owner(owner: str) -> int:
+    """
+    Look up the App installation for an org or user.
+
+    Cached per owner for ``INSTALLATION_ID_TTL`` seconds; an id whose token
+    request 404s (App reinstalled) is evicted straight away.
+    """
+    with _cache_lock:
+        installation_id = _installation_ids.get(owner)
+    if installation_id is not None:
+        return installation_id
+
     app_jwt = generate_jwt()
-    owner = repo.split("/")[0]
 
     # Try org installation first, then user
     for endpoint in [
-        f"https://api.github.com/orgs/{owner}/installation",
-        f"https://api.github.com/users/{owner}/installation",
+        f"{API}/orgs/{owner}/installation",
+        f"{API}/users/{owner}/installation",
     ]:
-        resp = requests.get(
+        resp = _SESSION.get(
             endpoint,
             headers={
                 "Authorization": f"Bearer {app_jwt}",
@@ -67,6 +181,9 @@ def get_installation_id_for_repo(repo: str) -> int:
             },
         )
         if resp.status_code == 200:
-            return resp.json()["id"]
+            installation_id = orjson.loads(resp.content)["id"]
+            with _cache_lock:
+                _installation_ids[owner] = installation_id
+            return installation_id
 
-    raise Exception(f"No GitHub App installation found for {repo}")
\ No newline at end of file
+    raise Exception(f"No GitHub App installation found for {owner}")
@@ -0,0 +1,74 @@
+import os
+import logging
+import threading
+from typing import Any
+import orjson
+from cachetools import LRUCache
+from services.github_auth import API
+
+logger = logging.getLogger(__name__)
+
+GRAPHQL_URL = f"{API}/graphql"
+
+# Last (ETag, JSON body, raw size) seen per GET request, shared by the sync
+# and async services.  GitHub answers a matching If-None-Match with 304 Not
+# Modified, which doesn't count against the rate limit, and we serve the
+# stored body.  Bounded by raw response bytes, not entry count, since one
+# recursive tree of a big monorepo can be tens of MB; parsed bodies take a
+# few times their raw size in memory.
+ETAG_CACHE_MAX_BYTES = int(os.getenv("ETAG_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+etag_cache: LRUCache = LRUCache(maxsize=ETAG_CACHE_MAX_BYTES, getsizeof=lambda entry: entry[2])
+etag_cache_lock = threading.Lock()
+
+
+def etag_lookup(url: str, params: dict | None) -> tuple[tuple, Any, dict | None]:
+    """
+    Prepare a conditional GET of *url* with query *params*.
+
+    Returns ``(key, cached, headers)`` — the cache key, the cached
+    ``(etag, body, size)`` entry or *None*, and the request headers to send.
+    """
+    key = (url, tuple(sorted(params.items())) if params else ())
+    with etag_cache_lock:
+        cached = etag_cache.get(key)
+    headers = {"If-None-Match": cached[0]} if cached is not None else None
+    return key, cached, headers
+
+
+def resolve_conditional(key: tuple, cached: Any, status: int, headers, content: bytes) -> tuple[int, Any]:
+    """
+    Turn the response to a conditional GET into ``(status_code, json_body)``.
+
+    A 304 is reported as 200 with the cached body, and the body is *None*
+    for any other non-200.  Fresh 200 bodies carrying an ETag are cached.
+    """
+    if status == 304 and cached is not None:
+        return 200, cached[1]
+    if status != 200:
+        return status, None
+
+    data = orjson.loads(content)
+    etag = headers.get("ETag")
+    # Bodies too big for the cache are just not revalidated next time
+    if etag and len(content) <= etag_cache.maxsize:
+        with etag_cache_lock:
+            etag_cache[key] = (etag, data, len(content))
+    return 200, data
+
+
+def graphql_data(status: int, content: bytes, allow_errors: bool = True) -> dict | None:
+    """
+    Return the ``data`` of a GraphQL response, or *None* on failure.
+
+    With *allow_errors* false, a response carrying any ``errors`` (partial
+    data, e.g. a field the token may not read) also counts as a failure.
+    """
+    if status != 200:
+        logger.warning("GraphQL request failed: %s", status)
+        return None
+    body = orjson.loads(content)
+    if body.get("errors"):
+        logger.warning("GraphQL errors: %s", body["errors"][:3])
+        if not allow_errors:
+            return None
+    return body.get("data")
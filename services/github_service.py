@@ -1,10 +1,19 @@
-import requests
+import asyncio
 import os
-import base64
+import hashlib
 import logging
+import threading
 import time
+from typing import Any
+import orjson
+import pybase64
+from cachetools import TTLCache
 from dotenv import load_dotenv
-from services.github_auth import get_installation_token, get_installation_id_for_repo
+from services.github_async import AsyncGitHubService, has_failed_run, summarize_completed_runs
+from services.github_auth import (
+    API, build_session, get_installation_token_with_expiry, get_installation_id_for_repo,
+)
+from services.github_http import GRAPHQL_URL, etag_lookup, graphql_data, resolve_conditional
 
 load_dotenv()
 
@@ -15,16 +24,34 @@ GITHUB_APP_ID = os.getenv("GITHUB_APP_ID")
 logger = logging.getLogger(__name__)
 
 # File extensions considered as source code when scanning repos
-CODE_EXTENSIONS = {
+CODE_EXTENSIONS = frozenset({
     ".py", ".js", ".ts", ".jsx", ".tsx", ".java", ".go", ".rs", ".rb",
     ".php", ".c", ".cpp", ".h", ".cs", ".yaml", ".yml", ".json", ".toml",
     ".cfg", ".ini", ".sh", ".bash", ".dockerfile", ".xml", ".gradle",
     ".kt", ".swift", ".scala", ".r", ".sql", ".html", ".css", ".scss",
-}
+})
 
-# How long we wait for CI to finish (seconds)
-CI_POLL_TIMEOUT = int(os.getenv("CI_POLL_TIMEOUT", "600"))  # 10 min default
-CI_POLL_INTERVAL = int(os.getenv("CI_POLL_INTERVAL", "20"))  # 20 sec default
+# Blobs requested per GraphQL query when fetching many files at once
+GRAPHQL_BLOB_BATCH = int(os.getenv("GRAPHQL_BLOB_BATCH", "100"))
+
+# Installation tokens are valid for 1 hour; reuse services for 50 minutes,
+# but rebuild one early once its token has less than 30 minutes left so a
+# whole push pipeline (CI wait, crew run, commits, PR) fits in its lifetime
+SERVICE_CACHE_TTL = 3000
+SERVICE_MIN_TOKEN_TTL = 1800
+_service_cache: TTLCache = TTLCache(maxsize=256, ttl=SERVICE_CACHE_TTL)
+_service_cache_lock = threading.Lock()
+
+# Default branch per repo.  It rarely changes, so skip the lookup entirely
+# for an hour rather than revalidating on every branch/PR operation.
+DEFAULT_BRANCH_TTL = int(os.getenv("DEFAULT_BRANCH_TTL", "3600"))
+_default_branch_cache: TTLCache = TTLCache(maxsize=256, ttl=DEFAULT_BRANCH_TTL)
+_default_branch_lock = threading.Lock()
+
+
+def _json(resp) -> Any:
+    """Parse a response body with orjson, several times faster than ``resp.json()``."""
+    return orjson.loads(resp.content)
 
 
 class GitHubService:
@@ -35,9 +62,10 @@ class GitHubService:
         a scoped token. Falls back to GITHUB_TOKEN (PAT) for local dev.
         """
         if GITHUB_APP_ID and installation_id:
-            token = get_installation_token(installation_id)
+            token, self.token_expires_at = get_installation_token_with_expiry(installation_id)
         elif GITHUB_TOKEN:
             token = GITHUB_TOKEN
+            self.token_expires_at = float("inf")  # PATs don't rotate
         else:
             raise RuntimeError("No GitHub authentication configured")
 
@@ -45,230 +73,258 @@ class GitHubService:
             "Authorization": f"Bearer {token}",
             "Accept": "application/vnd.github+json",
         }
+        # Pooled keep-alive connections; shared by every call on this service
+        self.session = build_session()
+        self.session.headers.update(self.headers)
 
     @classmethod
     def for_repo(cls, repo: str) -> "GitHubService":
-        """Create a GitHubService authenticated for the given repo's installation."""
+        """
+        Return a GitHubService authenticated for the given repo's installation.
+
+        Instances are cached per repo for ``SERVICE_CACHE_TTL`` seconds so a
+        single push doesn't mint a new installation token for every helper;
+        one whose token has less than ``SERVICE_MIN_TOKEN_TTL`` seconds left
+        is replaced with a freshly authenticated service.
+        """
+        with _service_cache_lock:
+            service = _service_cache.get(repo)
+        if service is not None and service.token_expires_at - time.time() > SERVICE_MIN_TOKEN_TTL:
+            return service
+
         if GITHUB_APP_ID:
             installation_id = get_installation_id_for_repo(repo)
-            return cls(installation_id=installation_id)
-        return cls()
+            service = cls(installation_id=installation_id)
+        else:
+            service = cls()
+
+        with _service_cache_lock:
+            _service_cache[repo] = service
+        return service
+
+    def _conditional_get(self, url: str, params: dict | None = None) -> tuple[int, Any]:
+        """
+        GET *url* revalidating against the cached ETag.
+
+        Returns ``(status_code, json_body)``; a 304 is reported as 200 with
+        the cached body, and the body is *None* for any other non-200.
+        """
+        key, cached, headers = etag_lookup(url, params)
+        resp = self.session.get(url, params=params, headers=headers)
+        return resolve_conditional(key, cached, resp.status_code, resp.headers, resp.content)
 
     # ── Repo metadata ────────────────────────────────────────────────
 
     def get_default_branch(self, repo: str) -> str:
         """Return the default branch name (e.g. 'main') for *repo*."""
-        url = f"https://api.github.com/repos/{repo}"
-        resp = requests.get(url, headers=self.headers)
-        if resp.status_code != 200:
-            return "main"
-        return resp.json().get("default_branch", "main")
+        with _default_branch_lock:
+            branch = _default_branch_cache.get(repo)
+        if branch is not None:
+            return branch
+
+        url = f"{API}/repos/{repo}"
+        status, data = self._conditional_get(url)
+        if status != 200:
+            return "main"  # not cached, so the next call retries
+        branch = data.get("default_branch", "main")
+        with _default_branch_lock:
+            _default_branch_cache[repo] = branch
+        return branch
 
     # ── CI / CD polling & logs ─────────────────────────────────────
 
     def get_workflow_runs_for_commit(self, repo: str, head_sha: str) -> list[dict]:
         """Return all workflow runs triggered for a specific commit SHA."""
-        url = f"https://api.github.com/repos/{repo}/actions/runs"
-        resp = requests.get(
-            url, params={"head_sha": head_sha, "per_page": 20}, headers=self.headers
-        )
-        if resp.status_code != 200:
-            logger.warning("Failed to list workflow runs for %s: %s", head_sha, resp.status_code)
-            return []
-        return resp.json().get("workflow_runs", [])
-
-    def get_check_suites_for_commit(self, repo: str, head_sha: str) -> list[dict]:
-        """Return all check suites for a specific commit SHA."""
-        url = f"https://api.github.com/repos/{repo}/commits/{head_sha}/check-suites"
-        resp = requests.get(url, headers=self.headers)
-        if resp.status_code != 200:
-            logger.warning("Failed to list check suites for %s: %s", head_sha, resp.status_code)
+        url = f"{API}/repos/{repo}/actions/runs"
+        status, data = self._conditional_get(url, params={"head_sha": head_sha, "per_page": 20})
+        if status != 200:
+            logger.warning("Failed to list workflow runs for %s: %s", head_sha, status)
             return []
-        return resp.json().get("check_suites", [])
+        return data.get("workflow_runs", [])
+
+    def get_ci_status(self, repo: str, head_sha: str, fail_fast: bool = True) -> dict:
+        """
+        Return the current CI state of *head_sha* without waiting.
+
+        Same shape as :meth:`wait_for_ci`, with status ``"pending"`` while
+        any workflow run is still queued or in progress — unless, with
+        *fail_fast*, one has already failed, which is reported as a
+        partial failure.
+        """
+        runs = self.get_workflow_runs_for_commit(repo, head_sha)
+        if not runs:
+            return {"status": "no_ci", "failed_runs": [], "all_runs": []}
+        if not all(r.get("status") == "completed" for r in runs):
+            if fail_fast and has_failed_run(runs):
+                return summarize_completed_runs(head_sha, runs, partial=True)
+            return {"status": "pending", "failed_runs": [], "all_runs": runs}
+        return summarize_completed_runs(head_sha, runs)
 
     def wait_for_ci(
         self, repo: str, head_sha: str,
-        timeout: int | None = None, interval: int | None = None,
+        timeout: int | None = None, interval: float | None = None,
+        fail_fast: bool = True,
     ) -> dict:
         """
         Poll GitHub until every CI workflow run for *head_sha* has completed.
 
-        Returns a dict::
-
-            {
-                "status": "failure" | "success" | "timeout" | "no_ci",
-                "failed_runs": [ {id, name, html_url, conclusion}, … ],
-                "all_runs":    [ … ],
-            }
+        Runs :meth:`AsyncGitHubService.wait_for_ci` on its own event loop;
+        see there for the result shape.
         """
-        timeout = timeout or CI_POLL_TIMEOUT
-        interval = interval or CI_POLL_INTERVAL
-        deadline = time.time() + timeout
-
-        logger.info("Waiting for CI on %s commit %s (timeout %ss)", repo, head_sha[:7], timeout)
-
-        # Give GitHub a moment to register the workflow runs
-        time.sleep(min(10, interval))
-
-        while True:
-            runs = self.get_workflow_runs_for_commit(repo, head_sha)
-
-            if not runs:
-                # No workflow runs found yet — could still be spinning up
-                if time.time() >= deadline:
-                    logger.info("No CI workflow runs found for %s within timeout", head_sha[:7])
-                    return {"status": "no_ci", "failed_runs": [], "all_runs": []}
-                time.sleep(interval)
-                continue
-
-            all_completed = all(r.get("status") == "completed" for r in runs)
-
-            if all_completed:
-                failed = [
-                    {
-                        "id": r["id"],
-                        "name": r.get("name", ""),
-                        "html_url": r.get("html_url", ""),
-                        "conclusion": r.get("conclusion", ""),
-                    }
-                    for r in runs
-                    if r.get("conclusion") in ("failure", "timed_out", "cancelled")
-                ]
-                status = "failure" if failed else "success"
-                logger.info(
-                    "CI completed for %s — %s (%d runs, %d failed)",
-                    head_sha[:7], status, len(runs), len(failed),
+        async def wait() -> dict:
+            async with AsyncGitHubService(self.headers) as gh:
+                return await gh.wait_for_ci(
+                    repo, head_sha, timeout=timeout, interval=interval, fail_fast=fail_fast,
                 )
-                return {"status": status, "failed_runs": failed, "all_runs": runs}
 
-            if time.time() >= deadline:
-                logger.warning("CI poll timeout for %s", head_sha[:7])
-                return {"status": "timeout", "failed_runs": [], "all_runs": runs}
+        return asyncio.run(wait())
 
-            pending = sum(1 for r in runs if r.get("status") != "completed")
-            logger.debug("CI not done — %d pending runs, retrying in %ds", pending, interval)
-            time.sleep(interval)
-
-    def get_workflow_run_logs(self, repo: str, run_id: int) -> str:
-        """Fetch the plain-text logs of every *failed* job in a workflow run."""
-        jobs_url = f"https://api.github.com/repos/{repo}/actions/runs/{run_id}/jobs"
-        resp = requests.get(jobs_url, headers=self.headers)
-
-        if resp.status_code != 200:
-            logger.warning("Failed to fetch jobs for run %s: %s", run_id, resp.status_code)
-            return ""
-
-        jobs = resp.json().get("jobs", [])
-        all_logs: list[str] = []
+    def get_logs_for_runs(self, repo: str, run_ids: list[int]) -> list[str | None]:
+        """
+        Fetch the failed-job logs of several workflow runs on one HTTP/2
+        client; see :meth:`AsyncGitHubService.get_logs_for_runs`.
+        """
+        async def fetch() -> list[str | None]:
+            async with AsyncGitHubService(self.headers) as gh:
+                return await gh.get_logs_for_runs(repo, run_ids)
 
-        for job in jobs:
-            if job.get("conclusion") != "failure":
-                continue
-            job_id = job["id"]
-            job_name = job.get("name", "unknown")
-            log_url = f"https://api.github.com/repos/{repo}/actions/jobs/{job_id}/logs"
-            log_resp = requests.get(log_url, headers=self.headers)
-
-            if log_resp.status_code == 200:
-                text = log_resp.text
-                # Keep the tail — errors are almost always at the end
-                if len(text) > 6000:
-                    text = "...(truncated)...\n" + text[-6000:]
-                all_logs.append(f"=== Job: {job_name} (id {job_id}) ===\n{text}")
-            else:
-                logger.warning("Failed to fetch logs for job %s: %s", job_id, log_resp.status_code)
-
-        return "\n\n".join(all_logs) if all_logs else "No failure logs available"
+        return asyncio.run(fetch())
 
     # ── Repository source code ───────────────────────────────────────
 
     def get_repo_tree(self, repo: str, ref: str = "main") -> list[dict]:
         """Return a list of ``{path, size}`` dicts for every code file in the repo."""
-        url = f"https://api.github.com/repos/{repo}/git/trees/{ref}?recursive=1"
-        resp = requests.get(url, headers=self.headers)
+        url = f"{API}/repos/{repo}/git/trees/{ref}"
+        status, data = self._conditional_get(url, params={"recursive": "1"})
 
-        if resp.status_code != 200:
-            logger.warning("Failed to fetch repo tree: %s", resp.status_code)
+        if status != 200:
+            logger.warning("Failed to fetch repo tree: %s", status)
             return []
 
+        # Trees of large monorepos run to 100k+ entries, so keep the loop tight
+        exts = CODE_EXTENSIONS
         files: list[dict] = []
-        for item in resp.json().get("tree", []):
+        append = files.append
+        for item in data.get("tree", []):
             if item["type"] != "blob":
                 continue
-            ext = os.path.splitext(item["path"])[1].lower()
-            if ext in CODE_EXTENSIONS:
-                files.append({"path": item["path"], "size": item.get("size", 0)})
+            path = item["path"]
+            name = path.rpartition("/")[2]
+            dot = name.rfind(".")
+            # dot == 0 is a dotfile such as ".bashrc", which has no extension
+            if dot <= 0 or name[dot:].lower() not in exts:
+                continue
+            append({"path": path, "size": item.get("size", 0)})
         return files
 
     def get_file_content(self, repo: str, path: str, ref: str = "main") -> str | None:
         """Return the UTF-8 content of a single file, or *None* on failure."""
-        url = f"https://api.github.com/repos/{repo}/contents/{path}"
-        resp = requests.get(url, params={"ref": ref}, headers=self.headers)
-        if resp.status_code != 200:
+        url = f"{API}/repos/{repo}/contents/{path}"
+        status, data = self._conditional_get(url, params={"ref": ref})
+        if status != 200:
             return None
-        data = resp.json()
         if data.get("encoding") == "base64":
-            return base64.b64decode(data["content"]).decode("utf-8", errors="replace")
+            return pybase64.b64decode(data["content"]).decode("utf-8", errors="replace")
         return data.get("content")
 
+    def get_files_content(self, repo: str, paths: list[str], ref: str = "main") -> dict[str, str]:
+        """
+        Return ``{path: text}`` for many files using batched GraphQL queries.
+
+        Each query fetches up to ``GRAPHQL_BLOB_BATCH`` blobs, so N files
+        cost ``ceil(N / batch)`` requests instead of N REST calls.  Binary
+        files map to an empty string; paths from a failed batch are left
+        out so callers can fall back to :meth:`get_file_content`.
+        """
+        owner, _, name = repo.partition("/")
+        contents: dict[str, str] = {}
+
+        for start in range(0, len(paths), GRAPHQL_BLOB_BATCH):
+            batch = paths[start:start + GRAPHQL_BLOB_BATCH]
+            var_defs = "".join(f", $e{i}: String!" for i in range(len(batch)))
+            fields = "\n".join(
+                f"f{i}: object(expression: $e{i}) {{ ... on Blob {{ text isBinary }} }}"
+                for i in range(len(batch))
+            )
+            query = (
+                f"query($owner: String!, $name: String!{var_defs}) {{\n"
+                f"  repository(owner: $owner, name: $name) {{\n{fields}\n  }}\n}}"
+            )
+            variables = {"owner": owner, "name": name}
+            variables.update({f"e{i}": f"{ref}:{p}" for i, p in enumerate(batch)})
+
+            data = self._graphql(query, variables)
+            repository = (data or {}).get("repository") or {}
+            for i, path in enumerate(batch):
+                blob = repository.get(f"f{i}")
+                if not blob:
+                    continue
+                contents[path] = "" if blob.get("isBinary") else blob.get("text") or ""
+
+        return contents
+
+    def _graphql(self, query: str, variables: dict) -> dict | None:
+        """POST a GraphQL query and return its ``data``, or *None* on failure."""
+        resp = self.session.post(GRAPHQL_URL, json={"query": query, "variables": variables})
+        return graphql_data(resp.status_code, resp.content)
+
     # ── Branch / commit / PR operations ──────────────────────────────
 
     def create_branch(self, repo, branch_name, base="main"):
         if not repo:
             raise ValueError("Repository name is required")
         
-        url = f"https://api.github.com/repos/{repo}/git/refs/heads/{base}"
+        url = f"{API}/repos/{repo}/git/refs/heads/{base}"
 
-        response = requests.get(url, headers=self.headers)
+        response = self.session.get(url)
         
         # Check if request was successful
         if response.status_code != 200:
-            error_msg = response.json().get("message", "Unknown error")
+            error_msg = _json(response).get("message", "Unknown error")
             raise Exception(f"Failed to get base branch '{base}': {error_msg} (Status: {response.status_code})")
         
-        data = response.json()
+        data = _json(response)
         if "object" not in data:
             raise Exception(f"Invalid response from GitHub API: {data}")
             
         sha = data["object"]["sha"]
 
-        create_url = f"https://api.github.com/repos/{repo}/git/refs"
+        create_url = f"{API}/repos/{repo}/git/refs"
 
         data = {
             "ref": f"refs/heads/{branch_name}",
             "sha": sha
         }
 
-        create_response = requests.post(create_url, json=data, headers=self.headers)
+        create_response = self.session.post(create_url, json=data)
         
         if create_response.status_code == 422:
             # Branch already exists — not an error
             return {"status": "already_exists", "ref": f"refs/heads/{branch_name}"}
         
         if create_response.status_code not in [200, 201]:
-            error_msg = create_response.json().get("message", "Unknown error")
+            error_msg = _json(create_response).get("message", "Unknown error")
             raise Exception(f"Failed to create branch '{branch_name}': {error_msg}")
         
-        return create_response.json()
+        return _json(create_response)
 
     def create_pr(self, repo, title, body, branch, base="main"):
         if not repo:
             raise ValueError("Repository name is required")
 
+        owner = repo.partition("/")[0]
+        url = f"{API}/repos/{repo}/pulls"
+
         # Check if a PR already exists for this branch
-        existing_url = f"https://api.github.com/repos/{repo}/pulls"
-        existing_response = requests.get(
-            existing_url,
-            params={"head": f"{repo.split('/')[0]}:{branch}", "state": "open"},
-            headers=self.headers
+        existing_response = self.session.get(
+            url,
+            params={"head": f"{owner}:{branch}", "state": "open"},
         )
         if existing_response.status_code == 200:
-            existing_prs = existing_response.json()
+            existing_prs = _json(existing_response)
             if existing_prs:
                 return existing_prs[0]  # Return the already-existing PR
 
-        url = f"https://api.github.com/repos/{repo}/pulls"
-
         data = {
             "title": title,
             "body": body,
@@ -276,35 +332,44 @@ class GitHubService:
             "base": base,
         }
 
-        response = requests.post(
-            url,
-            json=data,
-            headers=self.headers
-        )
+        response = self.session.post(url, json=data)
         
         if response.status_code == 422:
             # Validation failed — likely PR already exists or no diff
-            errors = response.json().get("errors", [])
-            error_msg = response.json().get("message", "Validation Failed")
+            body = _json(response)
+            errors = body.get("errors", [])
+            error_msg = body.get("message", "Validation Failed")
             raise Exception(f"Failed to create PR: {error_msg} — {errors}")
 
         if response.status_code not in [200, 201]:
-            error_msg = response.json().get("message", "Unknown error")
+            error_msg = _json(response).get("message", "Unknown error")
             raise Exception(f"Failed to create PR: {error_msg}")
 
-        return response.json()
+        return _json(response)
 
     def commit_file(self, repo, branch, file_path, content, message):
-        """Create or update a file on the given branch via the GitHub Contents API."""
-        url = f"https://api.github.com/repos/{repo}/contents/{file_path}"
+        """
+        Create or update a file on the given branch via the GitHub Contents API.
+
+        Returns ``{"status": "unchanged"}`` without committing when the
+        branch already has byte-identical content.
+        """
+        url = f"{API}/repos/{repo}/contents/{file_path}"
+
+        content_bytes = content.encode("utf-8")
 
         # Check if file already exists to get its SHA (needed for update)
-        existing = requests.get(url, params={"ref": branch}, headers=self.headers)
+        existing = self.session.get(url, params={"ref": branch})
         file_sha = None
         if existing.status_code == 200:
-            file_sha = existing.json().get("sha")
+            file_sha = _json(existing).get("sha")
+            # Same git blob SHA means identical content — skip the no-op commit
+            blob = b"blob %d\0" % len(content_bytes) + content_bytes
+            if file_sha == hashlib.sha1(blob).hexdigest():
+                logger.info("%s unchanged on %s — not committing", file_path, branch)
+                return {"status": "unchanged"}
 
-        encoded_content = base64.b64encode(content.encode("utf-8")).decode("utf-8")
+        encoded_content = pybase64.b64encode(content_bytes).decode("ascii")
 
         data = {
             "message": message,
@@ -314,25 +379,58 @@ class GitHubService:
         if file_sha:
             data["sha"] = file_sha
 
-        response = requests.put(url, json=data, headers=self.headers)
+        response = self.session.put(url, json=data)
 
         if response.status_code not in [200, 201]:
-            error_msg = response.json().get("message", "Unknown error")
+            error_msg = _json(response).get("message", "Unknown error")
             raise Exception(f"Failed to commit file '{file_path}': {error_msg}")
 
-        return response.json()
+        return _json(response)
+
+    def close_prs_with_comment(self, prs: list[dict], comment: str) -> tuple[set[int], set[int]]:
+        """
+        Comment on and close every PR in *prs* with a single GraphQL mutation.
+
+        *prs* are REST pull request objects (``node_id`` and ``number`` are
+        used).  Returns ``(commented, closed)``, the numbers of the PRs that
+        got the comment and of those that were closed, so callers can retry
+        only the part that failed.
+        """
+        prs = [pr for pr in prs if pr.get("node_id")]
+        if not prs:
+            return set(), set()
+
+        var_defs = "".join(f", $p{i}: ID!" for i in range(len(prs)))
+        fields = "\n".join(
+            f"c{i}: addComment(input: {{subjectId: $p{i}, body: $body}}) {{ commentEdge {{ node {{ id }} }} }}\n"
+            f"x{i}: closePullRequest(input: {{pullRequestId: $p{i}}}) {{ pullRequest {{ number }} }}"
+            for i in range(len(prs))
+        )
+        mutation = f"mutation($body: String!{var_defs}) {{\n{fields}\n}}"
+        variables = {"body": comment}
+        variables.update({f"p{i}": pr["node_id"] for i, pr in enumerate(prs)})
+
+        data = self._graphql(mutation, variables) or {}
+        commented = {
+            pr["number"] for i, pr in enumerate(prs)
+            if (data.get(f"c{i}") or {}).get("commentEdge")
+        }
+        closed = {
+            pr["number"] for i, pr in enumerate(prs)
+            if (data.get(f"x{i}") or {}).get("pullRequest")
+        }
+        return commented, closed
 
     def get_open_fix_prs(self, repo: str, base: str = "main") -> list[dict]:
         """Return all open PRs whose branch starts with 'fix/ci-'."""
-        url = f"https://api.github.com/repos/{repo}/pulls"
-        resp = requests.get(
+        url = f"{API}/repos/{repo}/pulls"
+        status, data = self._conditional_get(
             url,
             params={"state": "open", "base": base, "per_page": 50},
-            headers=self.headers,
         )
-        if resp.status_code != 200:
+        if status != 200:
             return []
         return [
-            pr for pr in resp.json()
+            pr for pr in data
             if pr.get("head", {}).get("ref", "").startswith("fix/ci-")
         ]